@@ -9,18 +9,51 @@ streamlit-photo-gallery
 """
 import os
 import time
+import base64
 import hashlib
+import io
+import html
+import mimetypes
+import multiprocessing
+import operator
+import sqlite3
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, NamedTuple
 import argparse
 
 import streamlit as st
 import streamlit.components.v1 as components
 from PIL import Image
 
+# Optional: losslessly shrinks thumbnail JPEGs ~20-30% via MozJPEG's
+# trellis quantization / better Huffman tables
+try:
+    import mozjpeg_lossless_optimization
+except ImportError:
+    mozjpeg_lossless_optimization = None
+
 IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".tiff"}
+# list_images already filters by extension, so Image.open can be pointed
+# straight at the right decoder instead of sniffing all registered formats
+EXT_TO_FORMATS = {
+    ".jpg": ["JPEG"],
+    ".jpeg": ["JPEG"],
+    ".png": ["PNG"],
+    ".gif": ["GIF"],
+    ".bmp": ["BMP"],
+    ".webp": ["WEBP"],
+    ".tiff": ["TIFF"],
+}
 THUMB_SIZE = (320, 320)
-THUMB_DIRNAME = ".thumbnails"
+PAGE_SIZE = 60
+# Thumbnails live under the app's static dir so the browser can fetch and
+# cache them over HTTP instead of receiving them through the WebSocket
+# (requires server.enableStaticServing, see .streamlit/config.toml)
+STATIC_THUMB_DIR = Path(__file__).resolve().parent / "static" / "thumbnails"
+# The manifest records absolute source paths, so it must stay outside the
+# web-served static/ tree; only the {hash}.jpg thumbnails are exposed
+MANIFEST_PATH = Path(__file__).resolve().parent / "thumbnails-manifest.sqlite"
 
 st.set_page_config(page_title="streamlit-photo-gallery", layout="wide")
 
@@ -62,36 +95,81 @@ div[role="dialog"]>button {
 # --------------------
 # Helpers
 # --------------------
-def list_subdirs(base: Path) -> List[Path]:
+class ImageEntry(NamedTuple):
+    """
+    One gallery image with its str path, basename and mtime precomputed, so
+    the per-rerun loops don't repeat Path -> str conversions per image.
+    """
+    path: Path
+    path_str: str
+    name: str
+    mtime: float
+
+
+def dir_mtime(dirpath: Path) -> float:
     try:
-        return sorted([p for p in base.iterdir() if p.is_dir()])
+        return dirpath.stat().st_mtime
+    except Exception:
+        return 0.0
+
+
+# ディレクトリのmtimeはエントリの増減で変わるので、(パス, mtime) をキーに
+# した短TTLキャッシュでrerunごとのlistdir+statを省ける
+@st.cache_data(ttl=60)
+def list_subdirs(base_str: str, base_mtime: float) -> List[Path]:
+    try:
+        return sorted([p for p in Path(base_str).iterdir() if p.is_dir()])
     except Exception:
         return []
 
 
-def list_images(dirpath: Path) -> List[Tuple[Path, float]]:
-    out: List[Tuple[Path, float]] = []
+@st.cache_data(ttl=60)
+def list_images(dirpath_str: str, dirpath_mtime: float) -> List[ImageEntry]:
+    dirpath = Path(dirpath_str)
+    out: List[ImageEntry] = []
     try:
-        for p in dirpath.iterdir():
-            if p.is_file() and p.suffix.lower() in IMAGE_EXTS:
-                out.append((p, p.stat().st_mtime))
+        # scandir caches stat results on the DirEntry, halving syscalls
+        # compared to iterdir + per-path stat; it also hands out path and
+        # name as plain strings without any Path allocation
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTS:
+                    out.append(ImageEntry(Path(entry.path), entry.path, entry.name, entry.stat().st_mtime))
     except Exception:
         pass
     return out
 
 
-def ensure_thumb_dir(dirpath: Path) -> Path:
-    td: Path = dirpath / THUMB_DIRNAME
-    td.mkdir(exist_ok=True)
-    return td
+def list_thumb_mtimes(thumb_dir: Path) -> Dict[str, float]:
+    """
+    One scandir over the thumbnail directory, so per-image freshness checks
+    become dict lookups instead of stat syscalls.
+    """
+    out: Dict[str, float] = {}
+    try:
+        with os.scandir(thumb_dir) as it:
+            for entry in it:
+                if entry.is_file():
+                    out[entry.name] = entry.stat().st_mtime
+    except Exception:
+        pass
+    return out
+
+
+def ensure_thumb_dir() -> Path:
+    STATIC_THUMB_DIR.mkdir(parents=True, exist_ok=True)
+    return STATIC_THUMB_DIR
 
 
 def thumb_path_for(image_path: Path, thumb_dir: Path) -> Path:
     """
     Use a stable hash-based filename for thumbnails and always use .jpg so
     all thumbnails have the same format and dimensions.
+
+    BLAKE2b-128 is faster than SHA-1 and halves the filename length; the
+    path is hashed unresolved since it already comes from a known parent.
     """
-    h = hashlib.sha1(str(image_path.resolve()).encode("utf-8")).hexdigest()
+    h = hashlib.blake2b(str(image_path).encode("utf-8"), digest_size=16).hexdigest()
     return thumb_dir / f"{h}.jpg"
 
 
@@ -105,31 +183,48 @@ def generate_thumbnail_if_needed(image_path: Path, thumb_path: Path, size=THUMB_
     This ensures all thumbnails have identical dimensions so the grid stays aligned.
     """
     try:
-        # If the thumb exists and is up-to-date, reuse it
+        # If the thumb exists and is up-to-date, reuse it (the batch pass in
+        # generate_thumbnails_in_parallel does its own syscall-free check
+        # against the scandir snapshot and manifest before submitting here)
         if thumb_path.exists() and thumb_path.stat().st_mtime >= image_path.stat().st_mtime:
             return thumb_path
 
-        with Image.open(image_path) as img:
-            # Convert to RGB to ensure consistent JPEG saving (handles RGBA/LA)
-            img = img.convert("RGBA")
-
-            # Compute target size preserving aspect ratio
-            src_w, src_h = img.size
+        with Image.open(image_path, formats=EXT_TO_FORMATS.get(image_path.suffix.lower())) as img:
+            # For JPEG sources this makes libjpeg decode at a reduced DCT
+            # scale (1/2, 1/4, 1/8), skipping most of the IDCT work; it is
+            # a no-op for other formats. Never let a decoder quirk here
+            # break thumbnailing, since draft is purely an optimization.
+            try:
+                img.draft("RGB", size)
+            except Exception:
+                pass
+
+            # Only go through RGBA when alpha actually matters; opaque JPEGs
+            # resize as 3-channel buffers (25% less bandwidth in the kernel)
+            has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+            if has_alpha:
+                img = img.convert("RGBA")
+            elif img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+
+            # thumbnail() shrinks in place preserving aspect ratio; the
+            # reducing_gap box-filter pre-reduction speeds up large downscales
+            img.thumbnail(size, Image.LANCZOS, reducing_gap=2.0)
+            resized = img
+            new_w, new_h = resized.size
             target_w, target_h = size
-            ratio = min(target_w / src_w, target_h / src_h)
-            new_w = max(1, int(src_w * ratio))
-            new_h = max(1, int(src_h * ratio))
-            resized = img.resize((new_w, new_h), resample=Image.LANCZOS)
 
             # Create white background canvas (RGB) and paste centered
             canvas = Image.new("RGB", size, (223, 223, 223))
             # If the resized image has alpha, composite onto white background first
-            if resized.mode in ("RGBA", "LA") or ("transparency" in resized.info):
+            if has_alpha and not (resized.mode == "RGBA" and resized.getextrema()[3] == (255, 255)):
                 bg = Image.new("RGBA", resized.size, (223, 223, 223, 255))
                 bg.paste(resized, (0, 0), resized)
                 resized_rgb = bg.convert("RGB")
             else:
-                resized_rgb = resized.convert("RGB")
+                # convert() copies the buffer even when the mode matches,
+                # so skip it entirely for sources that are already RGB
+                resized_rgb = resized if resized.mode == "RGB" else resized.convert("RGB")
 
             offset_x = (target_w - new_w) // 2
             offset_y = (target_h - new_h) // 2
@@ -137,7 +232,12 @@ def generate_thumbnail_if_needed(image_path: Path, thumb_path: Path, size=THUMB_
 
             # Ensure directory exists and save as JPEG
             thumb_path.parent.mkdir(parents=True, exist_ok=True)
-            canvas.save(thumb_path, format="JPEG", quality=85, optimize=True)
+            if mozjpeg_lossless_optimization is not None:
+                buf = io.BytesIO()
+                canvas.save(buf, format="JPEG", quality=85, optimize=True)
+                thumb_path.write_bytes(mozjpeg_lossless_optimization.optimize(buf.getvalue()))
+            else:
+                canvas.save(thumb_path, format="JPEG", quality=85, optimize=True)
 
         # Set thumb mtime to match source so update logic works
         try:
@@ -151,22 +251,170 @@ def generate_thumbnail_if_needed(image_path: Path, thumb_path: Path, size=THUMB_
         return image_path
 
 
+@st.cache_resource
+def load_manifest() -> Dict[str, float]:
+    """
+    Load the thumbnail manifest (source path -> source mtime at generation
+    time) into a dict once per session, so freshness checks don't need one
+    stat per thumbnail on every rerun.
+    """
+    # 旧バージョンはmanifestをstatic配下に置いていたため、公開されないよう
+    # 新しい場所へ移動しておく
+    try:
+        old_path = STATIC_THUMB_DIR / "manifest.sqlite"
+        if old_path.exists():
+            if MANIFEST_PATH.exists():
+                old_path.unlink()
+            else:
+                old_path.replace(MANIFEST_PATH)
+    except Exception:
+        pass
+    manifest: Dict[str, float] = {}
+    try:
+        with sqlite3.connect(MANIFEST_PATH) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS thumbs(src TEXT PRIMARY KEY, mtime REAL)")
+            for src, mtime in conn.execute("SELECT src, mtime FROM thumbs"):
+                manifest[src] = mtime
+    except Exception:
+        pass
+    return manifest
+
+
+def save_manifest_entries(entries: List[Tuple[str, float]]) -> None:
+    if not entries:
+        return
+    try:
+        with sqlite3.connect(MANIFEST_PATH) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS thumbs(src TEXT PRIMARY KEY, mtime REAL)")
+            conn.executemany("INSERT OR REPLACE INTO thumbs VALUES (?, ?)", entries)
+            conn.commit()
+    except Exception:
+        pass
+
+
+@st.cache_data(max_entries=10000)
+def resolve_thumb(image_path_str: str, mtime: float, thumb_dir_str: str) -> str:
+    """
+    Memoized thumbnail lookup keyed on (path, mtime). Streamlit re-executes
+    the whole script per interaction, so without this every rerun would
+    re-hash and re-stat every image.
+    """
+    image_path = Path(image_path_str)
+    thumb_dir = Path(thumb_dir_str)
+    return str(generate_thumbnail_if_needed(image_path, thumb_path_for(image_path, thumb_dir)))
+
+
+@st.cache_data(max_entries=10000)
+def thumb_data_uri(thumb_path_str: str, mtime: float) -> str:
+    """
+    Read + base64-encode a thumbnail once per (path, source mtime) so reruns
+    reuse the encoded payload instead of re-reading the file.
+    """
+    mime = mimetypes.guess_type(thumb_path_str)[0] or "image/jpeg"
+    with open(thumb_path_str, "rb") as f:
+        data = f.read()
+    return f"data:{mime};base64," + base64.b64encode(data).decode("ascii")
+
+
+@st.cache_resource
+def get_thumbnail_executor() -> Executor:
+    """
+    Keep one pool alive across reruns so thumbnail generation can use all
+    cores without paying worker startup cost on every interaction.
+
+    A process pool is only used where fork is available: under spawn
+    (Windows, macOS default) the workers would re-import this script, whose
+    module-level parse_args() exits on the multiprocessing argv. Pillow
+    releases the GIL during resize/encode, so threads are a reasonable
+    fallback there.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                   mp_context=multiprocessing.get_context("fork"))
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def _safe_getsize(p: Path) -> int:
+    try:
+        return p.stat().st_size
+    except Exception:
+        return 0
+
+
+def generate_thumbnails_in_parallel(images: List[ImageEntry], thumb_dir: Path) -> None:
+    """
+    Generate all missing/stale thumbnails up front on the process pool.
+    Thumbnailing is CPU-bound and embarrassingly parallel, so batching it
+    before the render loop cuts first-load time roughly by the core count.
+    """
+    manifest: Dict[str, float] = load_manifest()
+    thumb_mtimes: Dict[str, float] = list_thumb_mtimes(thumb_dir)
+    pending: List[ImageEntry] = []
+    thumbs: List[Path] = []
+    new_entries: List[Tuple[str, float]] = []
+    for e in images:
+        thumb_path = thumb_path_for(e.path, thumb_dir)
+        if thumb_path.name in thumb_mtimes:
+            if manifest.get(e.path_str) == e.mtime:
+                continue
+            if thumb_mtimes[thumb_path.name] >= e.mtime:
+                # Fresh thumb generated before the manifest existed; adopt it
+                new_entries.append((e.path_str, e.mtime))
+                continue
+        pending.append(e)
+        thumbs.append(thumb_path)
+    if pending:
+        # Largest sources first: with roughly cost-proportional file sizes
+        # this keeps pool workers evenly loaded so the batch finishes sooner
+        jobs = sorted(zip(pending, thumbs), key=lambda j: _safe_getsize(j[0].path), reverse=True)
+        pending = [j[0] for j in jobs]
+        thumbs = [j[1] for j in jobs]
+        executor = get_thumbnail_executor()
+        # list() waits for completion so the grid below only sees finished thumbs
+        try:
+            results = list(executor.map(generate_thumbnail_if_needed, [e.path for e in pending], thumbs))
+        except Exception:
+            # A broken pool must not take the gallery down; regenerate inline
+            results = [generate_thumbnail_if_needed(e.path, t) for e, t in zip(pending, thumbs)]
+        for e, thumb_path, result in zip(pending, thumbs, results):
+            if result == thumb_path:
+                new_entries.append((e.path_str, e.mtime))
+    # One batched write instead of N stats on every future rerun
+    if new_entries:
+        manifest.update(dict(new_entries))
+        save_manifest_entries(new_entries)
+
+
+def _unlink_one(p: str) -> Tuple[str, str]:
+    try:
+        os.remove(p)
+        return (p, None)
+    except Exception as e:
+        return (p, str(e))
+
+
 def delete_paths(paths: List[str]) -> Tuple[List[str], List[Tuple[str, str]]]:
     successes: List[str] = []
     failures: List[Tuple[str, str]] = []
-    for p in paths:
-        try:
-            os.remove(p)
-            successes.append(p)
-        except Exception as e:
-            failures.append((p, str(e)))
+    # unlinkはGILを解放するsyscallなのでスレッドで並行発行できる
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for p, err in executor.map(_unlink_one, paths):
+            if err is None:
+                successes.append(p)
+            else:
+                failures.append((p, err))
     return successes, failures
 
 
 # チェックボックスのON/OFFをキビキビ動かすためのworkaround
 def checkbox_on_change(i: int):
     def f():
-        st.session_state.checked[str(i)] = st.session_state[f"raw_checked_{i}"]
+        new = bool(st.session_state[f"raw_checked_{i}"])
+        old = bool(st.session_state.checked.get(str(i)))
+        # 全件走査しなくても選択数が分かるようにカウンタも更新する
+        if new != old:
+            st.session_state.checked_count += 1 if new else -1
+        st.session_state.checked[str(i)] = new
     return f
 
 
@@ -186,6 +434,8 @@ if "to_delete" not in st.session_state:
     st.session_state.to_delete: List[str] = []
 if "checked" not in st.session_state:
     st.session_state.checked: Dict[int, bool] = {}
+if "checked_count" not in st.session_state:
+    st.session_state.checked_count: int = 0
 
 
 # --------------------
@@ -200,7 +450,7 @@ if not base_dir.exists() or not base_dir.is_dir():
     st.sidebar.error("指定されたディレクトリが見つかりません。")
     st.stop()
 
-subdirs: List[Path] = list_subdirs(base_dir)
+subdirs: List[Path] = list_subdirs(str(base_dir), dir_mtime(base_dir))
 
 selected_subdir: List[str] = st.sidebar.selectbox("サブディレクトリを選択", ["."] + [p.name for p in subdirs])
 target_dir: Path = base_dir / selected_subdir
@@ -208,18 +458,28 @@ target_dir: Path = base_dir / selected_subdir
 sort_by = st.sidebar.selectbox("並び替え", ["名前 (昇順)", "名前 (降順)", "更新日時 (新しい順)", "更新日時 (古い順)"], 1)
 cols_per_row = st.sidebar.slider("1行当たりの項目数", 1, 6, 4)
 
-images: List[Tuple[Path, float]] = list_images(target_dir)
+images: List[ImageEntry] = list_images(str(target_dir), dir_mtime(target_dir))
 
-if sort_by == "名前 (昇順)":
-    images.sort(key=lambda x: x[0].name.lower())
-elif sort_by == "名前 (降順)":
-    images.sort(key=lambda x: x[0].name.lower(), reverse=True)
-elif sort_by == "更新日時 (新しい順)":
-    images.sort(key=lambda x: x[1], reverse=True)
+# Decorate-sort-undecorate: compute each key once (O(N)) instead of once
+# per comparison, so the sort itself runs without any Python-level callback
+if sort_by.startswith("名前"):
+    decorated = [(e.name.lower(), i) for i, e in enumerate(images)]
 else:
-    images.sort(key=lambda x: x[1])
+    decorated = [(e.mtime, i) for i, e in enumerate(images)]
+# itemgetterで先頭のキーだけ比較させる（tuple比較にするとindexまで比較対象に
+# なり、降順ソートで同値キーの元の並びが崩れてしまう）
+decorated.sort(key=operator.itemgetter(0), reverse=sort_by in ("名前 (降順)", "更新日時 (新しい順)"))
+images = [images[i] for _, i in decorated]
+
+# ページ単位で描画することでrerunあたりのコストを件数に依らず一定にする
+max_page = max(0, (len(images) - 1) // PAGE_SIZE)
+page: int = int(st.sidebar.number_input("ページ", min_value=0, max_value=max_page, value=0))
+visible: List[ImageEntry] = images[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
 
 if st.sidebar.button("リロード"):
+    # 中身だけ書き換わった場合はディレクトリのmtimeが変わらないので明示的に破棄する
+    list_subdirs.clear()
+    list_images.clear()
     st.rerun()
 
 st.sidebar.markdown("---")
@@ -230,20 +490,19 @@ with st.sidebar.container():
         if st.button("全選択"):
             for i, _ in enumerate(images):
                 st.session_state.checked[str(i)] = True
+            st.session_state.checked_count = len(images)
             # rerunしないとcheckboxに反映されないことがある
             st.rerun()
     with c2:
         if st.button("全解除"):
             st.session_state.checked = {}
+            st.session_state.checked_count = 0
             # rerunしないとcheckboxに反映されないことがある
             st.rerun()
-    to_delete: List[str] = []
-    for k, v in st.session_state.checked.items():
-        if v:
-            img_p = images[int(k)][0]
-            to_delete.append(str(img_p))
-    if st.sidebar.button(f"{len(to_delete)}件を削除", disabled=not bool(to_delete)):
-        st.session_state.to_delete = to_delete
+    # 選択数はカウンタで持ち、パスのリスト化はボタンが押されたときだけ行う
+    checked_count: int = st.session_state.checked_count
+    if st.sidebar.button(f"{checked_count}件を削除", disabled=checked_count == 0):
+        st.session_state.to_delete = [images[int(k)].path_str for k, v in st.session_state.checked.items() if v]
 
 
 # --------------------
@@ -255,25 +514,40 @@ if not images:
     st.info("このディレクトリに表示条件に合う画像が見つかりません。")
 else:
     # image grid
-    thumb_dir: Path = ensure_thumb_dir(target_dir)
+    thumb_dir: Path = ensure_thumb_dir()
+    generate_thumbnails_in_parallel(visible, thumb_dir)
     columns = st.columns(cols_per_row)
-    
-    for img_i, (img_p, _) in enumerate(images):
-        column = columns[img_i % cols_per_row]
-        thumb: Path = generate_thumbnail_if_needed(img_p, thumb_path_for(img_p, thumb_dir))
+
+    thumb_dir_str: str = str(thumb_dir)
+    for vis_i, e in enumerate(visible):
+        # session stateのキーはページをまたいで一意にするため全体indexを使う
+        img_i = page * PAGE_SIZE + vis_i
+        column = columns[vis_i % cols_per_row]
+        # list_images already captured st_mtime, so no extra stat here
+        thumb: str = resolve_thumb(e.path_str, e.mtime, thumb_dir_str)
+        thumb_p = Path(thumb)
+        if thumb_p.parent == STATIC_THUMB_DIR:
+            # Served over HTTP with browser caching; the mtime query busts
+            # the cache when the source changes (the hash name doesn't)
+            src = f"app/static/thumbnails/{thumb_p.name}?v={e.mtime}"
+        else:
+            # Thumbnail generation failed; inline the original as a fallback
+            src = thumb_data_uri(thumb, e.mtime)
         with column:
-            st.image(str(thumb), width='stretch', caption=img_p.name)
+            # loading=lazy/decoding=async defers off-screen decode to the
+            # browser's viewport tracking, which st.image can't express
+            st.markdown(
+                f'<img src="{src}" loading="lazy" decoding="async" style="width:100%">'
+                f'<div style="text-align:center;color:#808495;font-size:14px;">{html.escape(e.name)}</div>',
+                unsafe_allow_html=True,
+            )
             key = f"raw_checked_{img_i}"
             value = st.session_state.checked.get(str(img_i))
             st.checkbox("選択", key=key, value=value, on_change=checkbox_on_change(img_i))
-            b1, b2 = st.columns([1, 1])
-            with b1:
-                if st.button("拡大", key=f"preview_{img_i}"):
-                    st.session_state.preview_index = img_i
-            with b2:
-                if st.button("削除", key=f"delete_{img_i}"):
-                    to_delete = [str(img_p)]
-                    st.session_state.to_delete = to_delete
+            # Streamlitのwidget登録コストはrerunごとに件数分かかるので、
+            # グリッド側は最小限のwidgetに抑える（個別削除はプレビュー内で可能）
+            if st.button("拡大", key=f"preview_{img_i}"):
+                st.session_state.preview_index = img_i
 
 
 # --------------------
@@ -283,7 +557,7 @@ else:
 def show_preview():
     if "preview_index" in st.session_state:
         img_i: int = int(st.session_state.preview_index)
-        img_p: str = images[img_i][0]
+        img_p: Path = images[img_i].path
         st.image(img_p)
         st.write(f"パス: {img_p}")
         [c1, c2, c3] = st.columns([1, 1, 1])
@@ -334,8 +608,8 @@ def confirm_delete():
     to_delete: List[str] = st.session_state.to_delete or []
     to_delete: List[str] = to_delete[:200]
     st.warning(f"本当に削除しますか？ {len(to_delete)} 件の画像が削除されます。これは元に戻せません。")
-    for p in to_delete:
-        st.write(p)
+    # 1件ずつst.writeすると件数分のdeltaが飛ぶので1要素にまとめる
+    st.code("\n".join(to_delete), language=None)
     if st.button("削除を実行", key="dialog_confirm"):
         successes, failures = delete_paths(to_delete)
         if successes:
@@ -344,6 +618,7 @@ def confirm_delete():
             for p, err in failures:
                 st.error(f"削除失敗: {p} — {err}")
         st.session_state.checked = {}
+        st.session_state.checked_count = 0
         st.session_state.to_delete = []
         st.rerun()
 